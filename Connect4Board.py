@@ -1,78 +1,146 @@
-import copy
-from enum import Enum
-from collections import Counter
+import random
+import numpy as np
+from enum import IntEnum
+from numba import njit
 from typing import List, Tuple
 
 
-class Colour(Enum):
-    EMPTY = "⚫"
-    RED = "🔴"
-    YELLOW = "🟡"
+class Colour(IntEnum):
+    # Small ints rather than strings so comparisons are plain int comparisons
+    EMPTY = 0
+    RED = 1
+    YELLOW = 2
+
+
+# How each colour is drawn when printing the board
+COLOUR_GLYPH = {Colour.EMPTY: "⚫", Colour.RED: "🔴", Colour.YELLOW: "🟡"}
+
+
+# Seeded so that position hashes are the same between runs
+# The solver's opening book is keyed by these hashes, regenerate it with OpeningBook.py if the keys change
+_zobrist_random = random.Random(4)
+
+
+@njit(cache=True, nogil=True)
+def _has_win(b: int) -> bool:
+    """
+    Checks a single player's bitboard for 4 chips in a row
+    Each shift pairs a chip with its neighbour in one direction, then the pairs are paired up again
+    7 checks horizontal lines, 8 and 6 the two diagonals, 1 vertical lines
+    :param b: The bitboard of the player
+    :return: True if the bitboard contains a winning line
+    """
+    m = b & (b >> 7)
+    if m & (m >> 14):
+        return True
+    m = b & (b >> 8)
+    if m & (m >> 16):
+        return True
+    m = b & (b >> 6)
+    if m & (m >> 12):
+        return True
+    m = b & (b >> 1)
+    return bool(m & (m >> 2))
 
 
 class Connect4Board:
     ROWS, COLUMNS = 6, 7
+    # Bits per column in the bitboards, one extra sentinel bit on top of each column
+    COLUMN_BITS = ROWS + 1
+
+    # Index into self.bb for each player
+    PLAYER_INDEX = {Colour.RED: 0, Colour.YELLOW: 1}
+
+    # Zobrist keys, one random number per player per position (indexed row * COLUMNS + column)
+    # A board's hash is the xor of the keys of every chip placed
+    # Keys are 63 bits so hashes fit in the int64 arrays of the solver's compiled search
+    ZOBRIST = None
 
     WINNING_LINES = None
-    WINNING_LINES_BY_POSITION = None
+    # WINNING_LINES as a (lines, 4) array of bitboard indices, so lines can be checked all at once with numpy
+    WINNING_LINE_BITS = None
 
-    def __init__(self, moves_made = 0, last_move = (-1, -1), board = None, column_chip_count = None, available_moves = [True] * COLUMNS):
+    def __init__(self, moves_made = 0, last_move = (-1, -1), bb = None, heights = None, board_hash = None):
         """
         Constructor for Connect4Board
         self.moves_made used for determining game state
         self.winner game state
-        self.board tracks the chips placed in the game
-        self.column_chip_count tracks how many chips are stacked in each column
-        self.available_moves tracks which columns still have space to place a chip
+        self.bb tracks the chips placed in the game, one bitboard per player (RED, YELLOW)
+        self.heights tracks the bit index of the next free slot in each column, one byte per column
+        self.hash Zobrist hash of the chips placed, updated incrementally as moves are made
         self.winning_lines combinations of 4 adjacent board slots that constitute a win
+
+        Bitboard layout: each column takes 7 bits, bottom row first, the 7th bit is a sentinel so that
+        shifted lines can't wrap from one column into the next
+        .  .  .  .  .  .  .
+        5 12 19 26 33 40 47
+        4 11 18 25 32 39 46
+        3 10 17 24 31 38 45
+        2  9 16 23 30 37 44
+        1  8 15 22 29 36 43
+        0  7 14 21 28 35 42
         """
+        # Only generate these static variables once for speed
+        if Connect4Board.ZOBRIST is None:
+            Connect4Board.ZOBRIST = [[_zobrist_random.getrandbits(63) for i in range(self.ROWS * self.COLUMNS)]
+                                     for j in range(2)]
+        if Connect4Board.WINNING_LINES is None:
+            Connect4Board.WINNING_LINES = self.generate_winning_lines()
+        if Connect4Board.WINNING_LINE_BITS is None:
+            Connect4Board.WINNING_LINE_BITS = np.array(
+                [[col * self.COLUMN_BITS + self.ROWS - 1 - row for row, col in line] for line in self.WINNING_LINES],
+                dtype=np.int8)
+
         self.moves_made = moves_made
         self.last_move = last_move
         self.winner = Colour.EMPTY
 
-        if board is not None:
-            self.board = board
+        if bb is not None:
+            self.bb = bb
         else:
-            self.board = [[Colour.EMPTY for i in range(self.COLUMNS)] for j in range(self.ROWS)]
+            self.bb = [0, 0]
 
-        if column_chip_count is not None:
-            self.column_chip_count = column_chip_count
+        if heights is not None:
+            self.heights = heights
         else:
-            columns = []
-            for col in range(self.COLUMNS):
-                columns.append(col)
-            self.column_chip_count = Counter(columns)
-            for key in self.column_chip_count.keys():
-                self.column_chip_count[key] = 0
-
-        self.available_moves = available_moves
+            self.heights = bytearray(col * self.COLUMN_BITS for col in range(self.COLUMNS))
 
-        # Only generate these static variables once for speed
-        if Connect4Board.WINNING_LINES is None:
-            Connect4Board.WINNING_LINES = self.generate_winning_lines()
-        if Connect4Board.WINNING_LINES_BY_POSITION is None:
-            Connect4Board.WINNING_LINES_BY_POSITION = [[None for i in range(self.COLUMNS)] for j in range(self.ROWS)]
-            for i in range(Connect4Board.ROWS):
-                for j in range(Connect4Board.COLUMNS):
-                    Connect4Board.WINNING_LINES_BY_POSITION[i][j] = self.generate_winning_lines_for_positions(i, j)
+        if board_hash is not None:
+            self.hash = board_hash
+        else:
+            self.hash = self.__compute_hash()
 
         self.winning_lines = self.WINNING_LINES
-        self.winning_lines_by_positions = self.WINNING_LINES_BY_POSITION
 
     def __str__(self):
         board_string = ""
         for i in range(self.ROWS):
             for j in range(self.COLUMNS):
-                board_string += self.board[i][j].value
+                board_string += COLOUR_GLYPH[self.get_colour_at_position(i, j)]
             board_string += "\n"
         return board_string
 
-    def __deepcopy__(self, memodict={}):
-        last_move = (self.last_move[0], self.last_move[1])
-        new_board = [[col for col in row] for row in self.board]
-        new_column_chip_count = copy.copy(self.column_chip_count)
-        new_available_moves = [available for available in self.available_moves]
-        return Connect4Board(self.moves_made, last_move, new_board, new_column_chip_count, new_available_moves)
+    def __copy__(self):
+        return self.clone()
+
+    def __deepcopy__(self, memodict=None):
+        return self.clone()
+
+    def clone(self):
+        """
+        Copies the board without going through the constructor
+        Only the state that changes as moves are made is copied, the winning lines are shared
+        :return: A new board in the same position
+        """
+        new_board = Connect4Board.__new__(Connect4Board)
+        new_board.moves_made = self.moves_made
+        new_board.last_move = self.last_move
+        new_board.winner = self.winner
+        new_board.bb = self.bb[:]
+        new_board.heights = bytearray(self.heights)
+        new_board.hash = self.hash
+        new_board.winning_lines = self.winning_lines
+        return new_board
 
     def move_available(self, column: int) -> bool:
         """
@@ -80,53 +148,71 @@ class Connect4Board:
         :param column: The column to place the chip
         :return: Boolean, whether the column has room to play
         """
-        return self.available_moves[column]
+        return self.heights[column] % self.COLUMN_BITS != self.ROWS
 
-    def place_chip(self, player: Colour, column: int) -> None:
+    def place_chip(self, player: Colour, column: int) -> Tuple[int, int, Colour, Tuple[int, int]]:
         """
         Place a chip at the bottom of the selected column
         Simulate "dropping" the chip, should go to lowest (highest number) unoccupied row index
         :param player: the colour of the chip to place
         :param column: which column index to place in
-        :return: None
+        :return: Undo token, pass to unplace_chip to take the move back
         """
-        row_placed_at = self.ROWS - self.column_chip_count[column] - 1
-        if row_placed_at < 0:
+        if not self.move_available(column):
             raise ValueError("Tried to place chip in full column " + str(column))
-        self.board[row_placed_at][column] = player
-        self.__update_column_availability(column)
+        row_placed_at = self.ROWS - 1 - self.heights[column] % self.COLUMN_BITS
+        player_index = self.PLAYER_INDEX[player]
+        self.bb[player_index] |= 1 << self.heights[column]
+        self.hash ^= self.ZOBRIST[player_index][row_placed_at * self.COLUMNS + column]
+        self.heights[column] += 1
         self.moves_made += 1
+        undo_token = (player_index, column, self.winner, self.last_move)
         self.last_move = (row_placed_at, column)
-        self.winner = self.check_winner_from_last_move()
+        # Only the player who just moved can have won, and we already have their bitboard
+        if _has_win(self.bb[player_index]):
+            self.winner = player
+        else:
+            self.winner = Colour.EMPTY
+        return undo_token
 
-    def __update_column_availability(self, column: int) -> None:
+    def unplace_chip(self, undo_token: Tuple[int, int, Colour, Tuple[int, int]]) -> None:
         """
-        Called after placing a chip, increments column chip count
-        If column is now full set column not available for moves
-        :param column: which column the move was made in
+        Takes back a move made by place_chip, so the solver can search moves without copying the board
+        Moves must be taken back in the reverse order they were made
+        :param undo_token: The token returned by place_chip for the move
         :return: None
         """
-        self.column_chip_count[column] += 1
-        if self.column_chip_count[column] == self.ROWS:
-            self.available_moves[column] = False
+        player_index, column, self.winner, self.last_move = undo_token
+        self.heights[column] -= 1
+        self.bb[player_index] ^= 1 << self.heights[column]
+        row_placed_at = self.ROWS - 1 - self.heights[column] % self.COLUMN_BITS
+        self.hash ^= self.ZOBRIST[player_index][row_placed_at * self.COLUMNS + column]
+        self.moves_made -= 1
+
+    def __compute_hash(self) -> int:
+        """
+        Computes the Zobrist hash of the board from scratch, only needed when constructing from existing bitboards
+        :return: The xor of the Zobrist keys of every chip on the board
+        """
+        board_hash = 0
+        for row in range(self.ROWS):
+            for col in range(self.COLUMNS):
+                colour = self.get_colour_at_position(row, col)
+                if colour != Colour.EMPTY:
+                    board_hash ^= self.ZOBRIST[self.PLAYER_INDEX[colour]][row * self.COLUMNS + col]
+        return board_hash
 
     def check_winner_from_last_move(self) -> Colour:
         """
-        Checks the winning lines we have stored for each position, for the position of the last move made
+        Checks the bitboard of the player who made the last move for 4 in a row
         Faster implementation that doesn't check entire board, needed for minimax
         :return: Which colour of player has won the game, EMPTY if none
         """
         if self.last_move == (-1, -1):
             return Colour.EMPTY
-        last_row = self.last_move[0]
-        last_col = self.last_move[1]
-        last_move_colour = self.board[last_row][last_col]
-        for line in self.winning_lines_by_positions[last_row][last_col]:
-            # where line[0][0] is the row of the first coordinate, line[0][1] is the col of the first coordinate
-            if self.board[line[0][0]][line[0][1]] == last_move_colour and \
-                    self.board[line[1][0]][line[1][1]] == last_move_colour and \
-                    self.board[line[2][0]][line[2][1]] == last_move_colour:
-                return last_move_colour
+        last_move_colour = self.get_colour_at_position(self.last_move[0], self.last_move[1])
+        if _has_win(self.bb[self.PLAYER_INDEX[last_move_colour]]):
+            return last_move_colour
         return Colour.EMPTY
 
     def check_winner_from_board(self) -> Colour:
@@ -134,13 +220,10 @@ class Connect4Board:
         Evaluates the entire board to see if the game has been won
         :return: Which colour of player has won the game, EMPTY if none
         """
-        for line in self.winning_lines:
-            # where line[0][0] is the row of the first coordinate, line[0][1] is the col of the first coordinate
-            if self.board[line[0][0]][line[0][1]] != Colour.EMPTY and \
-                    self.board[line[0][0]][line[0][1]] == self.board[line[1][0]][line[1][1]] and \
-                    self.board[line[1][0]][line[1][1]] == self.board[line[2][0]][line[2][1]] and \
-                    self.board[line[2][0]][line[2][1]] == self.board[line[3][0]][line[3][1]]:
-                return self.board[line[0][0]][line[0][1]]
+        if _has_win(self.bb[0]):
+            return Colour.RED
+        if _has_win(self.bb[1]):
+            return Colour.YELLOW
         return Colour.EMPTY
 
     def still_playing(self):
@@ -156,7 +239,12 @@ class Connect4Board:
         return self.winner
 
     def get_colour_at_position(self, row, column):
-        return self.board[row][column]
+        position_mask = 1 << (column * self.COLUMN_BITS + self.ROWS - 1 - row)
+        if self.bb[0] & position_mask:
+            return Colour.RED
+        if self.bb[1] & position_mask:
+            return Colour.YELLOW
+        return Colour.EMPTY
 
     def get_moves_made(self):
         return self.moves_made
@@ -185,32 +273,9 @@ class Connect4Board:
                                                (starting_row + 2, starting_col + 2),
                                                (starting_row + 3, starting_col + 3)])
         diagonal_rising_lines = []
-        for starting_row in range(4, Connect4Board.ROWS):
+        for starting_row in range(3, Connect4Board.ROWS):
             for starting_col in range(Connect4Board.COLUMNS - 3):
                 diagonal_rising_lines.append([(starting_row, starting_col), (starting_row - 1, starting_col + 1),
                                               (starting_row - 2, starting_col + 2),
                                               (starting_row - 3, starting_col + 3)])
         return horizontal_lines + vertical_lines + diagonal_falling_lines + diagonal_rising_lines
-
-    @staticmethod
-    def generate_winning_lines_for_positions(row: int, column: int) -> List[List[Tuple[int, int]]]:
-        """
-        Generates a list of lines (lists) where each line is a winning line, excludes the position itself
-        Winning lines are included in this list if the line contains the position
-        We use these winning lines to be able to check if the game has been won based on the last move
-        can just check these lines rather than the entire board
-
-        >>> generate_winning_lines_for_positions(0, 0)
-        [[(0, 1), (0, 2), (0, 3)], [(1, 0), (2, 0), (3, 0)], [(1, 1), (3, 2), (3, 3)]]
-
-        :param row: The row of the position we want winning lines for
-        :param column: The column of the position we want winning lines for
-        :return: List of winning lines for the position, less the position
-        """
-        winning_lines = []
-        for line in Connect4Board.WINNING_LINES:
-            if (row, column) in line:
-                added_line = line[:]
-                added_line.remove((row, column))
-                winning_lines.append(added_line)
-        return winning_lines
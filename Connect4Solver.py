@@ -1,10 +1,181 @@
-import copy
+import os
+import pickle
 import random
+import numpy as np
+from numba import njit
 from numpy import inf
 from typing import List
 
 from Connect4Board import Colour as Colour
+from Connect4Board import COLOUR_GLYPH
 from Connect4Board import Connect4Board as Board
+from Connect4Board import _has_win
+
+# Order to try moves in during search, central columns are part of more winning lines so are more often the best move
+COLUMN_ORDER = (3, 2, 4, 1, 5, 0, 6)
+# The other player for each player
+OPPONENT = {Colour.RED: Colour.YELLOW, Colour.YELLOW: Colour.RED}
+# Used for scoring in minimax, 1 for RED or -1 for YELLOW
+PLAYER_VALUE = {Colour.RED: 1, Colour.YELLOW: -1}
+
+# COLUMN_ORDER with the given column moved to the front, for trying the best move from the transposition table first
+COLUMN_ORDER_WITH_FIRST = tuple((col,) + tuple(c for c in COLUMN_ORDER if c != col) for col in range(Board.COLUMNS))
+
+# Board dimensions as plain globals, the compiled search can't read class attributes
+ROWS, COLUMNS, COLUMN_BITS = Board.ROWS, Board.COLUMNS, Board.COLUMN_BITS
+
+# Transposition table entry flags, whether the stored value is exact or only a bound on the true value
+TT_EXACT, TT_LOWER_BOUND, TT_UPPER_BOUND = 0, 1, 2
+# Number of transposition table slots, must be a power of 2 so a hash can be masked into an index
+TT_SIZE = 1 << 20
+
+
+@njit(cache=True, nogil=True)
+def _search(bb_player, bb_opponent, heights, player_index, depth, alpha, beta, board_hash, zobrist, tt_keys, tt_vals):
+    """
+    Negamax depth first search of a tree of possible moves given a position, used for minimax
+    Goes down to the specified depth making all possible moves to try to find wins/draws
+    Uses alpha-beta pruning to stop searching a node once it can't change the result of its parent
+    Compiled with numba, so works on the bitboards directly rather than on a Connect4Board, and loops over
+    an explicit stack instead of recursing
+    Results are stored in the transposition table, as a bound on the value if the search was cut off
+    Each entry is packed into one int as ((depth * 4 + value + 1) * 4 + flag) * 8 + best column + 1, 0 if unused
+    :param bb_player: Bitboard of the player making the move for this iteration
+    :param bb_opponent: Bitboard of the other player
+    :param heights: Bit index of the next free slot in each column, restored before returning
+    :param player_index: Index of the player making the move, 0 for RED or 1 for YELLOW
+    :param depth: How many levels down to search
+    :param alpha: The value the player is already guaranteed elsewhere in the tree
+    :param beta: The value the opponent is already guaranteed elsewhere in the tree, negated
+    :param board_hash: Zobrist hash of the position
+    :param zobrist: Zobrist keys of the board, indexed [player index, row * COLUMNS + column]
+    :param tt_keys: Transposition table hashes
+    :param tt_vals: Transposition table packed entries
+    :return: 1 for a win for player, -1 for a win for the opponent, 0 for draw or inconclusive search
+    """
+    # The tree is walked with an explicit stack rather than recursion, one slot per level below the root
+    # holding what would be the local variables of a recursive call
+    stack_bb_player = np.empty(depth, dtype=np.int64)
+    stack_bb_opponent = np.empty(depth, dtype=np.int64)
+    stack_hash = np.empty(depth, dtype=np.int64)
+    stack_alpha = np.empty(depth, dtype=np.int64)
+    stack_beta = np.empty(depth, dtype=np.int64)
+    stack_alpha_original = np.empty(depth, dtype=np.int64)
+    stack_best_value = np.empty(depth, dtype=np.int64)
+    stack_best_col = np.empty(depth, dtype=np.int64)
+    # Best move from the transposition table to try first, -1 if none
+    stack_first_col = np.empty(depth, dtype=np.int64)
+    # How far through the move order each level is
+    stack_move_index = np.empty(depth, dtype=np.int64)
+    # The move being searched in the level below
+    stack_col = np.empty(depth, dtype=np.int64)
+
+    ply = 0
+    stack_bb_player[0] = bb_player
+    stack_bb_opponent[0] = bb_opponent
+    stack_hash[0] = board_hash
+    stack_alpha[0] = alpha
+    stack_beta[0] = beta
+    entering = True
+    result = 0
+    while True:
+        ply_depth = depth - ply
+        ply_player_index = player_index ^ (ply & 1)
+        tt_index = stack_hash[ply] & (TT_SIZE - 1)
+        returning = False
+        if entering:
+            # Starting to search this level, like the start of a recursive call
+            stack_alpha_original[ply] = stack_alpha[ply]
+            # Lower than any real value, so the first move searched always becomes the best
+            stack_best_value[ply] = -2
+            stack_best_col[ply] = -1
+            stack_first_col[ply] = -1
+            stack_move_index[ply] = 0
+            entry = tt_vals[tt_index]
+            if entry != 0 and tt_keys[tt_index] == stack_hash[ply]:
+                entry_best_col = entry % 8 - 1
+                entry_flag = entry // 8 % 4
+                entry_value = entry // 32 % 4 - 1
+                if entry // 128 >= ply_depth:
+                    if entry_flag == TT_LOWER_BOUND:
+                        stack_alpha[ply] = max(stack_alpha[ply], entry_value)
+                    elif entry_flag == TT_UPPER_BOUND:
+                        stack_beta[ply] = min(stack_beta[ply], entry_value)
+                    if entry_flag == TT_EXACT or stack_alpha[ply] >= stack_beta[ply]:
+                        result = entry_value
+                        returning = True
+                # Try the best move from an earlier search first, it is the most likely to cause a cutoff
+                stack_first_col[ply] = entry_best_col
+        else:
+            # The level below finished searching, like a recursive call returning
+            col = stack_col[ply]
+            heights[col] -= 1
+            value = -result
+            if value > stack_best_value[ply]:
+                stack_best_value[ply] = value
+                stack_best_col[ply] = col
+            stack_alpha[ply] = max(stack_alpha[ply], value)
+
+        if not returning:
+            searching_child = False
+            # for each child node (available moves), until the opponent won't allow this position
+            while stack_alpha[ply] < stack_beta[ply] and stack_move_index[ply] < COLUMNS:
+                if stack_first_col[ply] == -1:
+                    col = COLUMN_ORDER[stack_move_index[ply]]
+                else:
+                    col = COLUMN_ORDER_WITH_FIRST[stack_first_col[ply]][stack_move_index[ply]]
+                stack_move_index[ply] += 1
+                bit_index = heights[col]
+                if bit_index % COLUMN_BITS == ROWS:
+                    continue
+                new_bb_player = stack_bb_player[ply] | (1 << bit_index)
+                if _has_win(new_bb_player):
+                    value = 1
+                elif ply_depth > 1:
+                    # Search the move in the next level down, with the players swapped
+                    row_placed_at = ROWS - 1 - bit_index % COLUMN_BITS
+                    heights[col] += 1
+                    stack_col[ply] = col
+                    stack_bb_player[ply + 1] = stack_bb_opponent[ply]
+                    stack_bb_opponent[ply + 1] = new_bb_player
+                    stack_hash[ply + 1] = stack_hash[ply] ^ zobrist[ply_player_index, row_placed_at * COLUMNS + col]
+                    stack_alpha[ply + 1] = -stack_beta[ply]
+                    stack_beta[ply + 1] = -stack_alpha[ply]
+                    searching_child = True
+                    break
+                else: # hit the end of depth of tree
+                    value = 0
+
+                if value > stack_best_value[ply]:
+                    stack_best_value[ply] = value
+                    stack_best_col[ply] = col
+                stack_alpha[ply] = max(stack_alpha[ply], value)
+
+            if searching_child:
+                ply += 1
+                entering = True
+                continue
+
+            best_value = stack_best_value[ply]
+            # No moves left, board is full
+            if stack_best_col[ply] == -1:
+                best_value = 0
+
+            if best_value <= stack_alpha_original[ply]:
+                flag = TT_UPPER_BOUND
+            elif best_value >= stack_beta[ply]:
+                flag = TT_LOWER_BOUND
+            else:
+                flag = TT_EXACT
+            tt_keys[tt_index] = stack_hash[ply]
+            tt_vals[tt_index] = ((ply_depth * 4 + best_value + 1) * 4 + flag) * 8 + stack_best_col[ply] + 1
+            result = best_value
+
+        if ply == 0:
+            return result
+        ply -= 1
+        entering = False
+
 
 class Connect4Solver:
 
@@ -18,10 +189,27 @@ class Connect4Solver:
     SCORE_THREE = 5
     SCORE_MODIFIER_BLOCK_OPPONENT = 2/3
 
-    def __alternate_colour(self, initial_colour):
-        if initial_colour == Colour.RED:
-            return Colour.YELLOW
-        return Colour.RED
+    # Precomputed moves for the start of the game, generated by OpeningBook.py
+    OPENING_BOOK_PATH = "Resources/opening_book.pkl"
+    # The book has a move for every position with fewer than this many moves made
+    OPENING_BOOK_MOVES = 6
+    # How deep the book's moves were searched, much deeper than we can afford during a game
+    OPENING_BOOK_DEPTH = 12
+
+    def __init__(self):
+        """
+        Constructor for Connect4Solver
+        self.tt_keys, self.tt_vals transposition table, board hashes and their packed (depth searched, minimax value,
+        flag, best column) so positions reached through different move orders are only searched once
+        self.opening_book maps (board hash, index of the player to move) to the column to play, empty if not generated
+        """
+        self.tt_keys = np.zeros(TT_SIZE, dtype=np.int64)
+        self.tt_vals = np.zeros(TT_SIZE, dtype=np.int64)
+
+        self.opening_book = {}
+        if os.path.exists(self.OPENING_BOOK_PATH):
+            with open(self.OPENING_BOOK_PATH, "rb") as f:
+                self.opening_book = pickle.load(f)
 
     def play(self, game: Board):
         print(game)
@@ -53,10 +241,10 @@ class Connect4Solver:
                 self.make_player_move(game, player_colour)
                 if not game.still_playing():
                     break
-                self.make_ai_move(game, self.__alternate_colour(player_colour))
+                self.make_ai_move(game, OPPONENT[player_colour])
         else:
             while game.still_playing():
-                self.make_ai_move(game, self.__alternate_colour(player_colour))
+                self.make_ai_move(game, OPPONENT[player_colour])
                 if not game.still_playing():
                     break
                 self.make_player_move(game, player_colour)
@@ -69,7 +257,7 @@ class Connect4Solver:
     def make_player_move(self, game: Board, placing_colour: Colour):
         valid_input = False
         while not valid_input:
-            input_col = int(input("Input column to place " + placing_colour.value + ": "))
+            input_col = int(input("Input column to place " + COLOUR_GLYPH[placing_colour] + ": "))
             if 0 <= input_col < Board.COLUMNS and game.move_available(input_col):
                 valid_input = True
             else:
@@ -82,38 +270,48 @@ class Connect4Solver:
         game.place_chip(placing_colour, ai_move)
         print(game)
 
-    def solveBoard(self, game: Board, player: Colour) -> int:
+    def solveBoard(self, game: Board, player: Colour, max_depth: int = None) -> int:
         """
         Uses a mix of AI techniques to determine the optimal move given a game board
         :param game: The game state to solve
         :param player: The player for whom we want to find the optimal move
+        :param max_depth: How deep to search, by default depends on how far into the game we are
         :return: The column in which to play
         """
-        # If able to win with this move, do it
-        win_now = self.solveNaive(game, player)
-        if win_now != -1:
-            return win_now
-
-        # Block a potential winning move from the opponent
-        lose_next_turn = self.solveNaive(game, self.__alternate_colour(player))
-        if lose_next_turn != -1:
-            return lose_next_turn
-
-        if game.get_moves_made() < self.DEPTH:
-            minimax = self.solve_minimax(game, player, 2)
-        else:
-            minimax = self.solve_minimax(game, player, self.DEPTH)
+        book_move = self.opening_book.get((game.hash, Board.PLAYER_INDEX[player]))
+        if book_move is not None:
+            return book_move
+
+        # Values from the previous move were searched from a different root, don't reuse them
+        self.tt_vals.fill(0)
+
+        if max_depth is None:
+            if game.get_moves_made() < self.DEPTH:
+                max_depth = 2
+            else:
+                max_depth = self.DEPTH
+        # Iterative deepening, the best moves found by each search are kept in the transposition table
+        # and tried first by the next one so it can prune more
+        # Depth 1 already finds moves that win immediately and moves that let the opponent win next turn
+        minimax = None
+        for depth in range(1, max_depth + 1):
+            depth_minimax = self.solve_minimax(game, player, depth)
+            best_value = max(value * PLAYER_VALUE[player] for value in depth_minimax)
+            # If every move now loses, keep the shallower values so we pick a move that delays the loss
+            # e.g. blocking an immediate win even if the opponent has another one later
+            if best_value == -1 and minimax is not None:
+                break
+            minimax = depth_minimax
+            # A forced win found at this depth is the quickest one, deeper searches would only add slower wins
+            if best_value == 1:
+                break
         print ("Minimax values:")
         print(minimax)
-        optimal_moves = []
         if player == Colour.RED:
-            for col in range(Board.COLUMNS):
-                if minimax[col] == max(minimax):
-                    optimal_moves.append(col)
+            best_minimax = max(minimax)
         else:
-            for col in range(Board.COLUMNS):
-                if minimax[col] == min(minimax):
-                    optimal_moves.append(col)
+            best_minimax = min(minimax)
+        optimal_moves = [col for col in range(Board.COLUMNS) if minimax[col] == best_minimax]
 
         if len(optimal_moves) == 1:
             return optimal_moves[0]
@@ -124,7 +322,7 @@ class Connect4Solver:
         attacking_scores = self.solve_scoring(game, player)
         # Based on how much of an advantage the opponent would gain if they made this move
         # we don't want to allow these moves to happen, but will prioritize trying to win by attacking if both equal
-        prophylactic_scores = self.solve_scoring(game, self.__alternate_colour(player))
+        prophylactic_scores = self.solve_scoring(game, OPPONENT[player])
 
         score_sums = [0] * Board.COLUMNS
         for col in optimal_moves:
@@ -134,58 +332,23 @@ class Connect4Solver:
         print(score_sums)
 
         # Add the move(s) with the highest score from the minimax optimal moves
-        optimal_moves_from_scores = []
-        for move in optimal_moves:
-            if score_sums[move] == max(score_sums):
-                optimal_moves_from_scores.append(move)
+        best_score = max(score_sums[move] for move in optimal_moves)
+        optimal_moves_from_scores = [move for move in optimal_moves if score_sums[move] == best_score]
 
         if len(optimal_moves_from_scores) == 1:
             return optimal_moves_from_scores[0]
 
         # If we're still tied, prioritize the middle of the board
-        central_proximity = [0] * Board.COLUMNS
-        for move in optimal_moves_from_scores:
-            central_proximity[move] = Board.COLUMNS / 2 + 1 - abs(3 - move)
-
-        central_moves = []
-        for move in optimal_moves_from_scores:
-            if central_proximity[move] == max(central_proximity):
-                central_moves.append(move)
+        central_distance = min(abs(Board.COLUMNS // 2 - move) for move in optimal_moves_from_scores)
+        central_moves = [move for move in optimal_moves_from_scores
+                         if abs(Board.COLUMNS // 2 - move) == central_distance]
 
-        if len(central_moves) == 0:
+        if len(central_moves) == 1:
             return central_moves[0]
 
         # Still tied, just pick randomly
         return random.choice(central_moves)
 
-    def solveNaive(self, game: Board, player: Colour) -> int:
-        """
-        Check if there is a move for the current player to instantly win the game
-        :param game: The board instance
-        :param player: The colour of the player to place a chip
-        :return: The column that wins the game, -1 if none
-        """
-        col = 0
-        while col < Board.COLUMNS:
-            if game.move_available(col):
-                new_board = copy.deepcopy(game)
-                new_board.place_chip(player, col)
-                winner = new_board.get_winner()
-                if winner != Colour.EMPTY:
-                    return col
-            col += 1
-        return -1
-
-    def __player_value(self, player: Colour):
-        """
-        Used for scoring in minimax
-        :param player: The player to get a value for
-        :return: 1 for RED or -1 for YELLOW
-        """
-        if player == Colour.RED:
-            return 1
-        return -1
-
     def solve_minimax(self, game: Board, player: Colour, depth: int) -> List[float]:
         """
         Determines the values of playing a move in each column via minimax (depth first search)
@@ -196,58 +359,26 @@ class Connect4Solver:
         :param depth: How many nodes down to search
         :return: The list of outcomes, where positive values benefit RED and negative benefit YELLOW
         """
-        minimax_values = []
-        player_value = self.__player_value(player)
-        for col in range(Board.COLUMNS):
+        minimax_values = [0] * Board.COLUMNS
+        player_value = PLAYER_VALUE[player]
+        player_index = Board.PLAYER_INDEX[player]
+        zobrist = np.array(game.ZOBRIST, dtype=np.int64)
+        for col in COLUMN_ORDER:
             if not game.move_available(col):
-                minimax_values.append(-inf * player_value)
+                minimax_values[col] = -inf * player_value
                 continue
-            new_board = copy.deepcopy(game)
-            new_board.place_chip(player, col)
-            value = self.place_chip_recursive(new_board, self.__alternate_colour(player), depth)
-            minimax_values.append(value)
+            undo_token = game.place_chip(player, col)
+            if game.get_winner() != Colour.EMPTY:
+                value = 1
+            else:
+                # Values are only ever -1, 0 or 1, so this is the full window
+                heights = np.array(game.heights, dtype=np.int64)
+                value = -_search(game.bb[1 - player_index], game.bb[player_index], heights, 1 - player_index,
+                                 depth, -1, 1, game.hash, zobrist, self.tt_keys, self.tt_vals)
+            game.unplace_chip(undo_token)
+            minimax_values[col] = value * player_value
         return minimax_values
 
-    def place_chip_recursive(self, game: Board, player: Colour, depth: int) -> int:
-        """
-        Depth first search of a tree of possible moves given a position, used for minimax
-        Goes down to the specified depth making all possible moves to try to find wins/draws
-        Immediately returns if a win or draw is found - alpha-beta pruning to avoid searching more when there
-        is already a result
-        :param game: The board to solve
-        :param player: The player making the move for this iteration
-        :param depth: How many levels down to search
-        :return: 1 for RED win, -1 for YELLOW win, 0 for draw or inconclusive search
-        """
-        values = []
-        col = 0
-        while (col < Board.COLUMNS and game.move_available(col)): # for each child node (available moves)
-            new_board = copy.deepcopy(game)
-            new_board.place_chip(player, col)
-            winner = new_board.get_winner()
-            if winner == Colour.EMPTY and depth > 1:
-                value = self.place_chip_recursive(new_board, self.__alternate_colour(player), depth -1)
-            else: # hit the end of depth of tree or there is already a winner
-                if winner == Colour.EMPTY:
-                    value = 0
-                else:
-                    value = self.__player_value(winner)
-            values.append(value)
-
-            # alpha-beta pruning (no point checking other nodes)
-            if value == self.__player_value(player):
-                return value
-
-            col += 1
-
-        # Realistically this stuff is useless since all the values are 0, 1, or -1 (so we will return above)
-        if len(values) == 0:
-            return 0
-        if self.__player_value(player) == 1:
-            return max(values)
-        if self.__player_value(player) == -1:
-            return min(values)
-
     def solve_scoring(self, game: Board, player: Colour):
         """
         If naive algorithm and minimax can't find a result, score every possible move based on how close
@@ -256,14 +387,16 @@ class Connect4Solver:
         :param player: Whose turn it is
         :return: A list of scores corresponding to how good each move is at the index (column)
         """
+        player_index = Board.PLAYER_INDEX[player]
+        available_moves = [col for col in COLUMN_ORDER if game.move_available(col)]
+        # The player's bitboard after each possible move, all scored at once
+        move_bits = np.array([game.heights[col] for col in available_moves], dtype=np.int64)
+        player_bitboards = np.int64(game.bb[player_index]) | (np.int64(1) << move_bits)
+        move_scores = self.__score_bitboards(game, player_bitboards, game.bb[1 - player_index])
+
         scores = [0] * Board.COLUMNS
-        col = 0
-        while col < Board.COLUMNS:
-            if game.move_available(col):
-                new_board = copy.deepcopy(game)
-                new_board.place_chip(player, col)
-                scores[col] = self.get_score(new_board, player)
-            col += 1
+        for col, score in zip(available_moves, move_scores.tolist()):
+            scores[col] = score
         return scores
 
     def get_score(self, game: Board, player: Colour):
@@ -275,19 +408,22 @@ class Connect4Solver:
         :param player: Whose perspective we are evaluating the board from
         :return: The score for this board position2
         """
-        score = 0
-        for line in game.WINNING_LINES:
-            matching_colour_chips_in_line = 0
-            for position in line:
-                # If the line contains a piece of the other colour, it won't contribute to the score
-                if game.get_colour_at_position(position[0], position[1]) == self.__alternate_colour(player):
-                    break
-                # Figure out how many positions in the line are already desired colour, as opposed to empty
-                if game.get_colour_at_position(position[0], position[1]) == player:
-                    matching_colour_chips_in_line += 1
-            else: # executed after for loop unless we break
-                if matching_colour_chips_in_line == 2:
-                    score += self.SCORE_TWO
-                if matching_colour_chips_in_line == 3:
-                    score += self.SCORE_THREE
-        return score
+        player_index = Board.PLAYER_INDEX[player]
+        return int(self.__score_bitboards(game, np.int64(game.bb[player_index]), game.bb[1 - player_index]))
+
+    def __score_bitboards(self, game: Board, player_bitboards: np.ndarray, opponent_bitboard: int) -> np.ndarray:
+        """
+        Scores one or more bitboards of the player against the opponent's chips, see get_score
+        :param game: The board, for its winning lines
+        :param player_bitboards: Array of the player's bitboards to score, any shape
+        :param opponent_bitboard: The opponent's bitboard
+        :return: Array of scores, the same shape as player_bitboards
+        """
+        # Chips of each colour in each winning line, shape (..., lines, 4)
+        player_chips = (player_bitboards[..., np.newaxis, np.newaxis] >> game.WINNING_LINE_BITS) & 1
+        opponent_chips = (np.int64(opponent_bitboard) >> game.WINNING_LINE_BITS) & 1
+        # If the line contains a piece of the other colour, it won't contribute to the score
+        open_lines = ~opponent_chips.any(axis=-1)
+        matching_colour_chips_in_lines = player_chips.sum(axis=-1)
+        return self.SCORE_TWO * ((matching_colour_chips_in_lines == 2) & open_lines).sum(axis=-1) + \
+            self.SCORE_THREE * ((matching_colour_chips_in_lines == 3) & open_lines).sum(axis=-1)
@@ -0,0 +1,52 @@
+import contextlib
+import io
+import pickle
+import random
+
+from Connect4Board import Colour as Colour
+from Connect4Board import Connect4Board as Board
+from Connect4Solver import Connect4Solver, OPPONENT
+
+
+def add_positions(solver: Connect4Solver, game: Board, player: Colour, book: dict) -> None:
+    """
+    Adds the solver's move for this position and every position reachable from it to the book,
+    until the book has OPENING_BOOK_MOVES moves made
+    :param solver: The solver to find moves with, with no book of its own
+    :param game: The position to add, left unchanged
+    :param player: Whose turn it is
+    :param book: Maps (board hash, index of the player to move) to the column to play
+    :return: None
+    """
+    if game.get_moves_made() >= Connect4Solver.OPENING_BOOK_MOVES or not game.still_playing():
+        return
+    key = (game.hash, Board.PLAYER_INDEX[player])
+    # Already reached through a different move order, so everything after it is in the book too
+    if key in book:
+        return
+    # solveBoard prints its working, too much output for thousands of positions
+    with contextlib.redirect_stdout(io.StringIO()):
+        book[key] = solver.solveBoard(game, player, Connect4Solver.OPENING_BOOK_DEPTH)
+    for col in range(Board.COLUMNS):
+        if game.move_available(col):
+            undo_token = game.place_chip(player, col)
+            add_positions(solver, game, OPPONENT[player], book)
+            game.unplace_chip(undo_token)
+
+
+# Tied moves are picked randomly, keep the book the same between runs
+random.seed(4)
+
+solver = Connect4Solver()
+# Search every position rather than looking up an existing book
+solver.opening_book = {}
+
+opening_book = {}
+# Either colour can move first
+for first_player in (Colour.RED, Colour.YELLOW):
+    add_positions(solver, Board(), first_player, opening_book)
+
+with open(Connect4Solver.OPENING_BOOK_PATH, "wb") as f:
+    pickle.dump(opening_book, f)
+
+print("Opening book positions: " + str(len(opening_book)))